@@ -1,26 +1,47 @@
 import asyncio
+import functools
+import heapq
+import io
+import itertools
 import logging
+import logging.handlers
+import queue
 import sqlite3
 import aiohttp
 import json
+import math
 import os
+import re
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types
+from pathlib import Path
+from uuid import uuid4
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from config import *
+from database_manager import atomic_write_text
+
+# Настройка логирования: обработчики только кладут записи в очередь,
+# а запись в файл и консоль выполняет фоновый поток QueueListener (запускается в main)
+_log_queue = queue.SimpleQueue()
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [
+    logging.FileHandler('logs/bot.log', encoding='utf-8'),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
 
-# Настройка логирования
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+    format='%(message)s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
@@ -31,136 +52,384 @@ bot = Bot(
 )
 dp = Dispatcher()
 
-# Статистика точности
+# Статистика точности (сохраняется в STATS_FILE пачками по STATS_FLUSH_EVERY изменений)
 accuracy_stats = {"total": 0, "correct": 0}
+_stats_lock = asyncio.Lock()
+_stats_dirty = 0
+STATS_FLUSH_EVERY = 10
+
+# Кэш статей базы знаний (сбрасывается при изменении mtime/размера файла)
+_articles_cache = {"mtime": None, "size": None, "data": None}
+
+# Контекст ответов для обратной связи: id ответа -> вопрос, источник, пользователь
+_qa_context = OrderedDict()
+QA_CONTEXT_SIZE = 1024
+
+# Постоянное соединение с БД пользователей (открывается в DatabaseManager.init_db)
+_db_conn = None
+_db_lock = asyncio.Lock()
+
+# SQL-запросы задаются один раз: sqlite3 кэширует подготовленные выражения по тексту запроса
+_UPSERT_USER = "INSERT OR REPLACE INTO users (user_id, username, first_name, is_admin) VALUES (?, ?, ?, ?)"
+
+# Общая HTTP-сессия для запросов к HuggingFace (создается в main)
+_http_session = None
+
+# Запросы к HuggingFace в процессе выполнения: нормализованный вопрос -> задача
+_hf_inflight = {}
+
+# Перестроения индекса в процессе выполнения: (st_mtime_ns, st_size) -> задача
+_index_inflight = {}
+
+# LRU-кэш готовых ответов: нормализованный вопрос -> (ответ, скрипт, источник)
+_response_cache = OrderedDict()
+
+# Поиск: токены от 4 символов, параметры BM25 и бонус за точное совпадение фразы
+_TOKEN_RE = re.compile(r'[а-яёa-z0-9]{4,}')
+BM25_K1 = 1.5
+BM25_B = 0.75
+PHRASE_BONUS = 100
+BLOOM_BITS = 4096  # Размер фильтра Блума по триграммам статьи (степень двойки)
+
+# Разделитель статей в файле базы знаний
+_ARTICLE_SEPARATOR = b'=' * 50
+
+# Маркеры блоков статьи: скрипт для оператора и начало основного содержания
+_SCRIPT_MARKERS_RE = re.compile(r'💬|что сказать|скрипт|речь оператора|действия оператора', re.IGNORECASE)
+_CONTENT_MARKERS_RE = re.compile(r'СОДЕРЖАНИЕ:|Общая информация')
+
+@dataclass
+class ArticleIndex:
+    """Статьи базы знаний, разобранные один раз при загрузке (параллельные списки)"""
+    raw: list = field(default_factory=list)
+    lower: list = field(default_factory=list)
+    titles: list = field(default_factory=list)
+    main_content: list = field(default_factory=list)
+    scripts: list = field(default_factory=list)
+    blooms: list = field(default_factory=list)  # Битовые маски триграмм для быстрой проверки фразы
+    postings: dict = field(default_factory=dict)  # токен -> [(номер статьи, вес BM25)]
+    
+    def __len__(self):
+        return len(self.raw)
 
 class KnowledgeBase:
     @staticmethod
     def load_articles():
         """Загружает статьи из базы знаний"""
         try:
-            with open(KNOWLEDGE_FILE, 'r', encoding='utf-8') as f:
-                content = f.read()
-            articles = content.split('==================================================')
-            return [article.strip() for article in articles if article.strip()]
+            st = os.stat(KNOWLEDGE_FILE)
+            if KnowledgeBase.is_cache_fresh(st):
+                return _articles_cache["data"]
+            return KnowledgeBase.store_index(st, KnowledgeBase.build_index())
+        except FileNotFoundError:
+            # До первого обновления базы файла нет - это штатная ситуация, а не ошибка
+            return ArticleIndex()
+    
+    @staticmethod
+    async def load_articles_async():
+        """Как load_articles, но разбор изменившегося файла выполняется в отдельном потоке"""
+        try:
+            st = os.stat(KNOWLEDGE_FILE)
+            if KnowledgeBase.is_cache_fresh(st):
+                return _articles_cache["data"]
+            
+            # Одну версию файла строим один раз: остальные вызовы ждут ту же задачу
+            key = (st.st_mtime_ns, st.st_size)
+            task = _index_inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(asyncio.to_thread(KnowledgeBase.build_index))
+                _index_inflight[key] = task
+                task.add_done_callback(lambda _: _index_inflight.pop(key, None))
+            # shield: отмена одного ожидающего не должна отменять построение для остальных
+            index = await asyncio.shield(task)
+            
+            # Индекс устанавливает первый дождавшийся, остальные получают уже готовый
+            if KnowledgeBase.is_cache_fresh(st):
+                return _articles_cache["data"]
+            return KnowledgeBase.store_index(st, index)
         except FileNotFoundError:
-            logger.error("Файл базы знаний не найден")
-            return []
+            # До первого обновления базы файла нет - это штатная ситуация, а не ошибка
+            return ArticleIndex()
+    
+    @staticmethod
+    def is_cache_fresh(st):
+        """Проверяет, что кэш построен по текущей версии файла"""
+        return st.st_mtime_ns == _articles_cache["mtime"] and st.st_size == _articles_cache["size"]
+    
+    @staticmethod
+    def store_index(st, index):
+        """Кладет индекс в кэш (вызывать из потока event loop: сбрасывает кэш ответов)"""
+        _articles_cache.update(mtime=st.st_mtime_ns, size=st.st_size, data=index)
+        _response_cache.clear()
+        return index
     
     @staticmethod
-    def search_articles(query):
-        """Ищет статьи по запросу"""
-        articles = KnowledgeBase.load_articles()
-        relevant_articles = []
+    def build_index():
+        """Читает файл базы и строит поисковый индекс (не трогает глобальные кэши)"""
+        index = ArticleIndex()
+        token_counts = []
+        for article in KnowledgeBase.read_articles():
+            article_lower = article.lower()
+            index.raw.append(article)
+            index.lower.append(article_lower)
+            title, main_content, script = KnowledgeBase.parse_article(article)
+            index.titles.append(title)
+            index.main_content.append(main_content)
+            index.scripts.append(script)
+            index.blooms.append(KnowledgeBase.trigram_bloom(article_lower))
+            token_counts.append(Counter(_TOKEN_RE.findall(article_lower)))
         
-        for article in articles:
-            score = KnowledgeBase.calculate_relevance(article, query)
-            if score > 0:
-                relevant_articles.append((article, score))
+        KnowledgeBase.build_postings(index, token_counts)
+        return index
+    
+    @staticmethod
+    def read_articles():
+        """Читает файл базы и отдает статьи по одной"""
+        # Файл читаем целиком и сразу закрываем, а разбираем уже потом: открытый
+        # (или отображенный в память) файл в Windows не дает os.replace подменить базу
+        with open(KNOWLEDGE_FILE, 'rb') as f:
+            data = f.read()
         
-        relevant_articles.sort(key=lambda x: x[1], reverse=True)
-        return [article[0] for article in relevant_articles]
+        # Декодируется только текущая статья, копии всего текста в str нет
+        start = 0
+        while start <= len(data):
+            end = data.find(_ARTICLE_SEPARATOR, start)
+            if end == -1:
+                end = len(data)
+            article = data[start:end].decode('utf-8').replace('\r\n', '\n').strip()
+            if article:
+                yield article
+            start = end + len(_ARTICLE_SEPARATOR)
+    
+    @staticmethod
+    def invalidate_cache():
+        """Сбрасывает кэш статей после перезаписи базы знаний"""
+        _articles_cache.update(mtime=None, size=None, data=None)
+        _response_cache.clear()
     
     @staticmethod
-    def calculate_relevance(article, query):
-        """Вычисляет релевантность статьи запросу"""
-        query_words = set(query.lower().split())
-        article_lower = article.lower()
+    def save_knowledge(content):
+        """Перезаписывает базу знаний и время её обновления (синхронно, вызывать через to_thread)"""
+        # Подменяем файл атомарно, чтобы читатели не увидели базу наполовину
+        atomic_write_text(KNOWLEDGE_FILE, [content])
         
-        score = 0
-        for word in query_words:
-            if len(word) > 3:
-                score += article_lower.count(word) * len(word)
+        # Время сбора ищем только в заголовке, не разбивая всю базу на строки
+        collected_at = get_collection_time(io.StringIO(content))
+        if collected_at:
+            # Рядом со временем запоминаем, к какой версии файла оно относится
+            version = file_version(os.stat(KNOWLEDGE_FILE))
+            with open(LAST_UPDATE_FILE, 'w', encoding='utf-8') as f:
+                f.write(f"{version}\n{collected_at}")
+    
+    @staticmethod
+    def search_articles(query, index=None, limit=1):
+        """Ищет статьи по запросу, возвращает номера limit лучших статей в индексе"""
+        if index is None:
+            index = KnowledgeBase.load_articles()
+        query_lower = query.lower()
+        query_terms = set(_TOKEN_RE.findall(query_lower))
         
-        if query.lower() in article_lower:
-            score += 100
+        # BM25 считаем только по статьям из списков вхождений терминов запроса
+        scores = KnowledgeBase.calculate_relevance(index, query_terms)
         
-        return score
+        # Если ни один термин не нашелся целым словом (запрос из коротких слов или слово
+        # встречается только внутри более длинного: «платеж» в «платежей»), проверяем
+        # точное вхождение по всем статьям - фильтр Блума отсекает большинство из них
+        candidates = list(scores) if scores else range(len(index))
+        query_bloom = KnowledgeBase.trigram_bloom(query_lower)
+        for i in candidates:
+            # Если хоть одной триграммы фразы нет в фильтре, фразы в статье точно нет
+            if index.blooms[i] & query_bloom != query_bloom:
+                continue
+            if query_lower in index.lower[i]:
+                scores[i] = scores.get(i, 0) + PHRASE_BONUS
+        
+        # Нужны только лучшие статьи, поэтому вместо полной сортировки берем top-K.
+        # Порядок scores зависит от хэшей строк, поэтому при равных баллах явно
+        # предпочитаем статью, стоящую в базе раньше (как при стабильной сортировке)
+        relevant_articles = ((i, score) for i, score in scores.items() if score > 0)
+        return [i for i, _ in heapq.nlargest(limit, relevant_articles, key=lambda x: (x[1], -x[0]))]
     
     @staticmethod
-    def extract_script(article):
-        """Извлекает скрипт для оператора из статьи"""
+    def build_postings(index, token_counts):
+        """Строит списки вхождений с заранее посчитанными весами BM25 (idf * tf-норма)"""
+        total = len(token_counts)
+        if not total:
+            return
+        doc_len = [sum(counts.values()) for counts in token_counts]
+        avgdl = sum(doc_len) / total or 1
+        
+        postings = {}
+        for doc_id, counts in enumerate(token_counts):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[doc_id] / avgdl)
+            for token, tf in counts.items():
+                postings.setdefault(token, []).append((doc_id, tf * (BM25_K1 + 1) / (tf + norm)))
+        
+        for token, docs in postings.items():
+            idf = math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            index.postings[token] = [(doc_id, idf * weight) for doc_id, weight in docs]
+    
+    @staticmethod
+    def trigram_bloom(text):
+        """Строит фильтр Блума (два хэша на триграмму) в виде битовой маски int"""
+        bloom = 0
+        mask = BLOOM_BITS - 1
+        for trigram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            h = hash(trigram)
+            bloom |= (1 << (h & mask)) | (1 << ((h >> 12) & mask))
+        return bloom
+    
+    @staticmethod
+    def calculate_relevance(index, query_terms):
+        """Вычисляет BM25-релевантность статей, содержащих термины запроса"""
+        scores = {}
+        for term in query_terms:
+            for i, weight in index.postings.get(term, ()):
+                scores[i] = scores.get(i, 0) + weight
+        return scores
+    
+    @staticmethod
+    def parse_article(article):
+        """Разбирает статью за один проход: заголовок, основное содержание и скрипт оператора"""
         lines = article.split('\n')
+        title = None
+        content_lines = []
+        in_content = False
+        content_done = False
+        meaningful_lines = []
         script_lines = []
+        script_end = None
         
-        # Ищем блоки с инструкциями для оператора
         for i, line in enumerate(lines):
-            line_lower = line.lower()
-            if any(keyword in line_lower for keyword in ['💬', 'что сказать', 'скрипт', 'речь оператора', 'действия оператора']):
-                # Берем следующие 3-5 строк как скрипт
-                for j in range(i+1, min(i+6, len(lines))):
-                    if lines[j].strip() and not lines[j].startswith('---') and '===' not in lines[j]:
-                        script_lines.append(lines[j].strip())
+            stripped = line.strip()
+            
+            # Заголовок: первая строка «СТАТЬЯ N: ...» или «Заголовок: ...»
+            if title is None and (('СТАТЬЯ' in line and ':' in line) or 'Заголовок:' in line):
+                title = line.split(':', 1)[1].strip()
+            
+            # Скрипт: до 5 строк после первого блока с инструкциями для оператора
+            if script_end is None:
+                if _SCRIPT_MARKERS_RE.search(line):
+                    script_end = i + 6
+            elif i < script_end:
+                if stripped and not line.startswith('---') and '===' not in line:
+                    script_lines.append(stripped)
+            
+            # Основное содержание: строки после «СОДЕРЖАНИЕ:» до конца блока
+            if not content_done:
+                if _CONTENT_MARKERS_RE.search(line):
+                    in_content = True
+                elif in_content and stripped:
+                    if line.startswith('---') or '========' in line:
+                        content_done = True
+                    elif len(stripped) > 10:  # Только значимые строки
+                        content_lines.append(stripped)
+                        if len(content_lines) >= 10:  # Больше 10 строк в ответ не попадает
+                            content_done = True
+            
+            # Запасной вариант содержания: первые значимые строки статьи
+            if len(meaningful_lines) < 5 and len(stripped) > 20 and not line.startswith(('===', '---', 'МО', 'Поиск')):
+                meaningful_lines.append(stripped)
+            
+            # Всё нужное уже найдено: остаток длинной статьи не просматриваем
+            if (title is not None and content_done and script_end is not None and i + 1 >= script_end
+                    and (content_lines or len(meaningful_lines) >= 5)):
                 break
         
-        return '\n'.join(script_lines) if script_lines else None
+        if content_lines:
+            main_content = '\n'.join(content_lines)
+        elif meaningful_lines:
+            main_content = '\n'.join(meaningful_lines)
+        else:
+            main_content = article[:300] + "..."
+        
+        script = '\n'.join(script_lines) if script_lines else None
+        return title or "Статья из базы знаний", main_content, script
+    
+    @staticmethod
+    def extract_script(article):
+        """Извлекает скрипт для оператора из статьи"""
+        return KnowledgeBase.parse_article(article)[2]
 
 class ResponseGenerator:
     @staticmethod
     async def generate_response(question):
         """Генерирует ответ на вопрос"""
-        # Сначала ищем в базе знаний
-        relevant_articles = KnowledgeBase.search_articles(question)
+        # Проверяем актуальность базы: при изменении файла кэш ответов сбрасывается
+        index = await KnowledgeBase.load_articles_async()
+        cache_key = ResponseGenerator.normalize_question(question)
+        if cache_key in _response_cache:
+            _response_cache.move_to_end(cache_key)
+            return _response_cache[cache_key]
+        
+        # Сначала ищем в базе знаний. Ищем по самому ключу кэша, чтобы один ключ
+        # всегда означал один и тот же результат поиска
+        relevant_articles = KnowledgeBase.search_articles(cache_key, index)
         
         if relevant_articles:
-            best_article = relevant_articles[0]
-            content = ResponseGenerator.extract_main_content(best_article)
-            script = KnowledgeBase.extract_script(best_article)
-            title = ResponseGenerator.get_article_title(best_article)
+            # Содержание, скрипт и заголовок разобраны заранее при загрузке базы
+            best = relevant_articles[0]
+            content = index.main_content[best]
+            script = index.scripts[best]
+            title = index.titles[best]
             
-            return content, script, title
+            return ResponseGenerator.cache_response(cache_key, (content, script, title))
         
         # Если в базе нет ответа, используем нейросеть
         ai_response = await ResponseGenerator.ask_huggingface(question)
         if ai_response:
-            return ai_response, None, "Нейросеть"
+            result = (ai_response, None, "Нейросеть")
+            # Пока ждали нейросеть, базу могли обновить: такой ответ относится
+            # к старой базе, и в кэш новой его класть нельзя
+            if _articles_cache["data"] is index:
+                ResponseGenerator.cache_response(cache_key, result)
+            return result
         else:
+            # Неудачу не кэшируем, чтобы следующий такой же вопрос снова попал в нейросеть
             return "К сожалению, я не нашел информации по вашему вопросу в базе знаний. Пожалуйста, обратитесь к старшему оператору.", None, "Не найдено"
     
+    @staticmethod
+    def normalize_question(question):
+        """Приводит вопрос к ключу кэша: регистр и пробелы по краям не учитываются.
+        
+        Пунктуацию не отбрасываем: она участвует в поиске точной фразы.
+        """
+        return question.strip().lower()
+    
+    @staticmethod
+    def cache_response(cache_key, result):
+        """Сохраняет ответ в LRU-кэш и возвращает его"""
+        _response_cache[cache_key] = result
+        _response_cache.move_to_end(cache_key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+        return result
+    
     @staticmethod
     def extract_main_content(article):
         """Извлекает основное содержание статьи"""
-        lines = article.split('\n')
-        content_lines = []
-        in_content = False
-        
-        for line in lines:
-            if 'СОДЕРЖАНИЕ:' in line or 'Общая информация' in line:
-                in_content = True
-                continue
-            if in_content and line.strip():
-                if line.startswith('---') or '========' in line:
-                    break
-                if len(line.strip()) > 10:  # Только значимые строки
-                    content_lines.append(line.strip())
-        
-        if content_lines:
-            return '\n'.join(content_lines[:10])  # Ограничиваем длину
-        
-        # Если не нашли структурированного содержания, возвращаем первые значимые строки
-        meaningful_lines = []
-        for line in lines:
-            if line.strip() and len(line.strip()) > 20 and not line.startswith(('===', '---', 'МО', 'Поиск')):
-                meaningful_lines.append(line.strip())
-            if len(meaningful_lines) >= 5:
-                break
-        
-        return '\n'.join(meaningful_lines) if meaningful_lines else article[:300] + "..."
+        return KnowledgeBase.parse_article(article)[1]
     
     @staticmethod
     def get_article_title(article):
         """Извлекает заголовок статьи"""
-        lines = article.split('\n')
-        for line in lines:
-            if 'СТАТЬЯ' in line and ':' in line:
-                return line.split(':', 1)[1].strip()
-            if 'Заголовок:' in line:
-                return line.split(':', 1)[1].strip()
-        return "Статья из базы знаний"
+        return KnowledgeBase.parse_article(article)[0]
     
     @staticmethod
     async def ask_huggingface(prompt):
-        """Запрос к HuggingFace API"""
+        """Запрос к HuggingFace API (одинаковые одновременные запросы выполняются один раз)"""
+        key = ResponseGenerator.normalize_question(prompt)
+        task = _hf_inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(ResponseGenerator.request_huggingface(prompt))
+            _hf_inflight[key] = task
+            task.add_done_callback(lambda _: _hf_inflight.pop(key, None))
+        # shield: отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+    
+    @staticmethod
+    async def request_huggingface(prompt):
+        """Выполняет HTTP-запрос к HuggingFace API"""
         try:
             headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}"}
             payload = {
@@ -173,30 +442,28 @@ class ResponseGenerator:
                 }
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    HUGGINGFACE_API_URL, 
-                    headers=headers, 
-                    json=payload,
-                    timeout=REQUEST_TIMEOUT
-                ) as response:
+            async with _http_session.post(
+                HUGGINGFACE_API_URL, 
+                headers=headers, 
+                json=payload
+            ) as response:
+                
+                if response.status == 200:
+                    result = await response.json()
+                    logger.info(f"HuggingFace response: {result}")
                     
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"HuggingFace response: {result}")
-                        
-                        if isinstance(result, list) and len(result) > 0:
-                            if 'generated_text' in result[0]:
-                                return result[0]['generated_text']
-                            else:
-                                return str(result[0])
+                    if isinstance(result, list) and len(result) > 0:
+                        if 'generated_text' in result[0]:
+                            return result[0]['generated_text']
                         else:
-                            return str(result)
+                            return str(result[0])
                     else:
-                        error_text = await response.text()
-                        logger.error(f"HuggingFace API error {response.status}: {error_text}")
-                        return None
-                        
+                        return str(result)
+                else:
+                    error_text = await response.text()
+                    logger.error(f"HuggingFace API error {response.status}: {error_text}")
+                    return None
+                    
         except asyncio.TimeoutError:
             logger.error("Timeout from HuggingFace API")
             return None
@@ -204,14 +471,91 @@ class ResponseGenerator:
             logger.error(f"HuggingFace request error: {e}")
             return None
 
+class WriteQueue:
+    """Копит записи в БД и сбрасывает их пачками (executemany в одной транзакции)"""
+    
+    def __init__(self, max_batch=100, flush_interval=0.05):
+        self.queue = asyncio.Queue()
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.task = None
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        """Дописывает всё, что осталось в очереди, и останавливает фоновую задачу"""
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+    
+    async def enqueue(self, sql, params):
+        await self.queue.put((sql, params))
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            
+            # Добираем пачку: до max_batch записей или flush_interval секунд
+            items = [item]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            
+            await self.flush(items)
+            if stopping:
+                return
+    
+    async def flush(self, items):
+        try:
+            async with _db_lock:
+                await asyncio.to_thread(self.write_batch, items)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи пачки в БД ({len(items)} записей): {e}")
+    
+    @staticmethod
+    def write_batch(items):
+        """Записывает пачку одной транзакцией, подряд идущие одинаковые запросы — через executemany"""
+        _db_conn.execute("BEGIN")
+        try:
+            for sql, group in itertools.groupby(items, key=lambda item: item[0]):
+                _db_conn.executemany(sql, [params for _, params in group])
+            _db_conn.execute("COMMIT")
+        except sqlite3.Error:
+            _db_conn.execute("ROLLBACK")
+            raise
+
+write_queue = WriteQueue()
+
 class DatabaseManager:
     @staticmethod
     def init_db():
         """Инициализация базы данных"""
-        conn = sqlite3.connect(USER_DB_FILE)
-        cursor = conn.cursor()
+        global _db_conn
+        
+        # Одно соединение на всё время работы бота: кэш страниц SQLite не теряется между запросами
+        _db_conn = sqlite3.connect(USER_DB_FILE, check_same_thread=False, isolation_level=None)
+        _db_conn.execute("PRAGMA journal_mode=WAL")
+        _db_conn.execute("PRAGMA synchronous=NORMAL")
+        _db_conn.execute("PRAGMA temp_store=MEMORY")
+        _db_conn.execute("PRAGMA cache_size=-64000")
         
-        cursor.execute('''
+        _db_conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -220,49 +564,60 @@ class DatabaseManager:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
-        conn.commit()
-        conn.close()
     
     @staticmethod
-    def save_user(user_id, username, first_name):
+    async def save_user(user_id, username, first_name):
         """Сохраняет пользователя в БД"""
-        conn = sqlite3.connect(USER_DB_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, is_admin)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username, first_name, user_id in ADMIN_IDS))
-        
-        conn.commit()
-        conn.close()
+        # Запись ставится в очередь и попадает в БД пачкой в фоновом потоке
+        await write_queue.enqueue(_UPSERT_USER, (user_id, username, first_name, user_id in ADMIN_IDS))
+    
+    @staticmethod
+    def close_db():
+        """Закрывает соединение с БД"""
+        if _db_conn is not None:
+            _db_conn.close()
 
-# Клавиатуры
-def main_menu_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📚 Задать вопрос", callback_data="ask_question")],
-        [InlineKeyboardButton(text="🔍 Совет по разговору", callback_data="conversation_tips")],
-        [InlineKeyboardButton(text="📊 Статистика точности", callback_data="accuracy_stats")],
-        [InlineKeyboardButton(text="⚙️ Админ-панель", callback_data="admin_panel")]
-    ])
+# Клавиатуры (неизменяемые создаются один раз при импорте)
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📚 Задать вопрос", callback_data="ask_question")],
+    [InlineKeyboardButton(text="🔍 Совет по разговору", callback_data="conversation_tips")],
+    [InlineKeyboardButton(text="📊 Статистика точности", callback_data="accuracy_stats")],
+    [InlineKeyboardButton(text="⚙️ Админ-панель", callback_data="admin_panel")]
+])
 
-def admin_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить базу", callback_data="update_base")],
-        [InlineKeyboardButton(text="🗑️ Очистить базу", callback_data="clear_base")],
-        [InlineKeyboardButton(text="📤 Экспорт базы", callback_data="export_base")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
-    ])
+ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Обновить базу", callback_data="update_base")],
+    [InlineKeyboardButton(text="🗑️ Очистить базу", callback_data="clear_base")],
+    [InlineKeyboardButton(text="📤 Экспорт базы", callback_data="export_base")],
+    [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
+])
 
-def accuracy_keyboard(message_id):
+CONFIRM_CLEAR_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="✅ Да, очистить", callback_data="confirm_clear"),
+        InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_clear")
+    ]
+])
+
+def accuracy_keyboard(answer_id):
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="✅ Да", callback_data=f"correct_{message_id}"),
-            InlineKeyboardButton(text="❌ Нет", callback_data=f"incorrect_{message_id}")
+            InlineKeyboardButton(text="✅ Да", callback_data=f"correct_{answer_id}"),
+            InlineKeyboardButton(text="❌ Нет", callback_data=f"incorrect_{answer_id}")
         ]
     ])
 
+# Проверка прав
+def admin_only(handler):
+    """Пропускает callback к обработчику только для администраторов"""
+    @functools.wraps(handler)
+    async def wrapper(callback: types.CallbackQuery, **kwargs):
+        if callback.from_user.id not in ADMIN_IDS:
+            await callback.answer("❌ Доступ только для администраторов", show_alert=True)
+            return
+        return await handler(callback, **kwargs)
+    return wrapper
+
 # Обработчики команд
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -270,24 +625,21 @@ async def cmd_start(message: types.Message):
     user_name = message.from_user.first_name
     
     # Сохраняем пользователя
-    DatabaseManager.save_user(user_id, message.from_user.username, user_name)
+    await DatabaseManager.save_user(user_id, message.from_user.username, user_name)
     
-    # Создаем базу знаний если её нет
-    if not os.path.exists(KNOWLEDGE_FILE):
-        with open(KNOWLEDGE_FILE, 'w', encoding='utf-8') as f:
-            f.write("=== БАЗА ЗНАНИЙ ===\nВремя создания: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-    
-    articles_count = len(KnowledgeBase.load_articles())
+    # Файл базы знаний создается при первом обновлении базы;
+    # до этого load_articles_async возвращает пустой индекс
+    articles_count = len(await KnowledgeBase.load_articles_async())
     
     await message.answer(
         f"🤖 <b>Добро пожаловать, {user_name}!</b>\n\n"
         f"Я - бот-помощник для операторов МосОблЕИРЦ\n\n"
         f"📚 Статей в базе: <b>{articles_count}</b>\n"
         f"🎯 Точность ответов: <b>{get_accuracy()}</b>",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
 
-@dp.callback_query(lambda c: c.data == "ask_question")
+@dp.callback_query(F.data == "ask_question")
 async def ask_question(callback: types.CallbackQuery):
     await callback.message.answer(
         "💬 <b>Задайте ваш вопрос:</b>\n\n"
@@ -299,7 +651,7 @@ async def ask_question(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "conversation_tips")
+@dp.callback_query(F.data == "conversation_tips")
 async def conversation_tips(callback: types.CallbackQuery):
     tips = """
 🎯 <b>Советы по разговору с клиентом:</b>
@@ -329,15 +681,11 @@ async def conversation_tips(callback: types.CallbackQuery):
     await callback.message.answer(tips)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "accuracy_stats")
+@dp.callback_query(F.data == "accuracy_stats")
+@admin_only
 async def show_accuracy(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    if user_id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ только для администраторов", show_alert=True)
-        return
-    
-    articles_count = len(KnowledgeBase.load_articles())
-    last_update = get_last_update_time()
+    articles_count = len(await KnowledgeBase.load_articles_async())
+    last_update = await asyncio.to_thread(get_last_update_time)
     
     stats_text = f"""
 📊 <b>Статистика бота:</b>
@@ -355,27 +703,19 @@ async def show_accuracy(callback: types.CallbackQuery):
     await callback.message.answer(stats_text)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "admin_panel")
+@dp.callback_query(F.data == "admin_panel")
+@admin_only
 async def admin_panel(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    if user_id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ только для администраторов", show_alert=True)
-        return
-    
     await callback.message.answer(
         "⚙️ <b>Панель администратора</b>\n\n"
         "Управление базой знаний и настройками бота",
-        reply_markup=admin_keyboard()
+        reply_markup=ADMIN_KB
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "update_base")
+@dp.callback_query(F.data == "update_base")
+@admin_only
 async def update_base(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    if user_id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ только для администраторов", show_alert=True)
-        return
-    
     await callback.message.answer(
         "🔄 <b>Запуск обновления базы знаний...</b>\n\n"
         "Для демонстрации создается тестовая база знаний.\n"
@@ -446,67 +786,53 @@ URL: https://mes1-kms.interrao.ru/content/space/7/article/8536
 ==================================================
 """
     
-    with open(KNOWLEDGE_FILE, 'w', encoding='utf-8') as f:
-        f.write(test_knowledge)
+    # Запись на диск выполняется в отдельном потоке, чтобы не блокировать остальных пользователей
+    await asyncio.to_thread(KnowledgeBase.save_knowledge, test_knowledge)
+    KnowledgeBase.invalidate_cache()
     
     await callback.message.answer("✅ <b>Тестовая база знаний создана!</b>\n\nТеперь бот готов к работе с демонстрационными данными.")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "clear_base")
+@dp.callback_query(F.data == "clear_base")
+@admin_only
 async def clear_base(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    if user_id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ только для администраторов", show_alert=True)
-        return
-    
-    confirm_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Да, очистить", callback_data="confirm_clear"),
-            InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_clear")
-        ]
-    ])
-    
     await callback.message.answer(
         "⚠️ <b>Очистка базы знаний</b>\n\n"
         "Вы уверены, что хотите полностью очистить базу знаний?\n"
         "Это действие нельзя отменить!",
-        reply_markup=confirm_keyboard
+        reply_markup=CONFIRM_CLEAR_KB
     )
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "export_base")
+@dp.callback_query(F.data == "export_base")
+@admin_only
 async def export_base(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    if user_id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ только для администраторов", show_alert=True)
-        return
-    
     try:
-        if os.path.exists(KNOWLEDGE_FILE):
-            with open(KNOWLEDGE_FILE, 'rb') as file:
-                await callback.message.answer_document(
-                    types.BufferedInputFile(
-                        file.read(),
-                        filename=f"knowledge_export_{datetime.now().strftime('%Y%m%d_%H%M')}.txt"
-                    ),
-                    caption="📤 <b>Экспорт базы знаний</b>"
-                )
-        else:
-            await callback.message.answer("❌ Файл базы знаний не найден")
+        # Файл читается один раз в отдельном потоке и отправляется из памяти
+        data = await asyncio.to_thread(Path(KNOWLEDGE_FILE).read_bytes)
+        await callback.message.answer_document(
+            types.BufferedInputFile(
+                data,
+                filename=f"knowledge_export_{datetime.now():%Y%m%d_%H%M}.txt"
+            ),
+            caption="📤 <b>Экспорт базы знаний</b>"
+        )
+    except FileNotFoundError:
+        await callback.message.answer("❌ Файл базы знаний не найден")
     except Exception as e:
         await callback.message.answer(f"❌ Ошибка экспорта: {str(e)}")
     
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "back_to_main")
+@dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: types.CallbackQuery):
-    articles_count = len(KnowledgeBase.load_articles())
+    articles_count = len(await KnowledgeBase.load_articles_async())
     
     await callback.message.answer(
         f"🤖 <b>Главное меню</b>\n\n"
         f"📚 Статей в базе: <b>{articles_count}</b>\n"
         f"🎯 Точность ответов: <b>{get_accuracy()}</b>",
-        reply_markup=main_menu_keyboard()
+        reply_markup=MAIN_MENU_KB
     )
     await callback.answer()
 
@@ -545,11 +871,18 @@ async def handle_questions(message: types.Message):
         if script:
             await message.answer(f"💬 <b>Что сказать клиенту:</b>\n{script}")
         
+        # Запоминаем вопрос, чтобы обратная связь не восстанавливала его из сообщений
+        # (message_id уникален только в пределах чата, поэтому ключ — случайный id ответа)
+        answer_id = uuid4().int & 0xffffffff
+        _qa_context[answer_id] = {"question": question, "title": source, "user_id": user_id}
+        if len(_qa_context) > QA_CONTEXT_SIZE:
+            _qa_context.popitem(last=False)
+        
         # Спрашиваем о точности ответа
-        accuracy_stats["total"] += 1
+        await record_accuracy("total")
         await message.answer(
             "✅ Правильно ли я ответил?",
-            reply_markup=accuracy_keyboard(accuracy_stats["total"])
+            reply_markup=accuracy_keyboard(answer_id)
         )
         
     except Exception as e:
@@ -557,29 +890,36 @@ async def handle_questions(message: types.Message):
         await thinking_msg.edit_text("❌ Произошла ошибка при поиске ответа")
 
 # Обработчик обратной связи
-@dp.callback_query(lambda c: c.data.startswith(('correct_', 'incorrect_')))
+@dp.callback_query(F.data.startswith("correct_") | F.data.startswith("incorrect_"))
 async def handle_accuracy_feedback(callback: types.CallbackQuery):
-    action, count = callback.data.split('_')
+    action, answer_id = callback.data.split('_')
+    context = _qa_context.get(int(answer_id))
     
     if action == "correct":
-        accuracy_stats["correct"] += 1
+        await record_accuracy("correct")
         await callback.message.edit_text("✅ Спасибо за обратную связь! Ответ помечен как правильный.")
     else:
         # Уведомляем администратора
-        question = callback.message.reply_to_message.text
+        question = context["question"] if context else "Неизвестно"
+        source = context["title"] if context else "Неизвестно"
         admin_message = (
             f"⚠️ <b>Неверный ответ бота</b>\n\n"
             f"❓ Вопрос: {question}\n"
+            f"📚 Источник: {source}\n"
             f"👤 Пользователь: {callback.from_user.first_name}\n"
             f"🆔 User ID: {callback.from_user.id}\n"
             f"📅 Время: {datetime.now().strftime('%H:%M:%S')}"
         )
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(admin_id, admin_message)
-            except Exception as e:
-                logger.error(f"Не удалось уведомить администратора {admin_id}: {e}")
+        # Рассылаем всем администраторам параллельно, ошибки логируем по каждому
+        admin_ids = list(ADMIN_IDS)
+        results = await asyncio.gather(
+            *(bot.send_message(admin_id, admin_message) for admin_id in admin_ids),
+            return_exceptions=True
+        )
+        for admin_id, result in zip(admin_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось уведомить администратора {admin_id}: {result}")
         
         await callback.message.edit_text(
             "❌ Спасибо за обратную связь! Администратор уведомлен об ошибке.\n"
@@ -589,41 +929,123 @@ async def handle_accuracy_feedback(callback: types.CallbackQuery):
     await callback.answer()
 
 # Вспомогательные функции
+def load_accuracy_stats():
+    """Загружает сохраненную статистику точности"""
+    try:
+        with open(STATS_FILE, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        accuracy_stats["total"] = int(saved.get("total", 0))
+        accuracy_stats["correct"] = int(saved.get("correct", 0))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось загрузить статистику точности: {e}")
+
+def save_accuracy_stats(stats):
+    """Атомарно сохраняет статистику точности"""
+    atomic_write_text(STATS_FILE, [json.dumps(stats)])
+
+async def record_accuracy(key):
+    """Увеличивает счетчик статистики и периодически сбрасывает её на диск"""
+    global _stats_dirty
+    async with _stats_lock:
+        accuracy_stats[key] += 1
+        _stats_dirty += 1
+        if _stats_dirty >= STATS_FLUSH_EVERY:
+            await flush_accuracy_stats()
+
+async def flush_accuracy_stats():
+    """Сохраняет накопленные изменения статистики (вызывать под _stats_lock)"""
+    global _stats_dirty
+    if not _stats_dirty:
+        return
+    try:
+        await asyncio.to_thread(save_accuracy_stats, dict(accuracy_stats))
+        _stats_dirty = 0
+    except OSError as e:
+        logger.error(f"Не удалось сохранить статистику точности: {e}")
+
 def get_accuracy():
     if accuracy_stats["total"] == 0:
         return "0%"
     accuracy = (accuracy_stats["correct"] / accuracy_stats["total"]) * 100
     return f"{accuracy:.1f}%"
 
+def get_collection_time(lines):
+    """Ищет время сбора в заголовке базы (до первого разделителя статей)"""
+    for line in lines:
+        if 'Время сбора:' in line:
+            return line.split('Время сбора: ')[1].strip()
+        if line.startswith('====='):
+            break
+    return None
+
+def file_version(st):
+    """Версия файла по результату os.stat: время изменения в наносекундах и размер"""
+    return f"{st.st_mtime_ns} {st.st_size}"
+
 def get_last_update_time():
+    # Время последнего обновления хранится в отдельном файле рядом с базой вместе
+    # с версией базы, для которой оно записано. Сравнивать mtime файлов нельзя:
+    # восстановление из резервной копии возвращает базе старый mtime
+    try:
+        with open(LAST_UPDATE_FILE, 'r', encoding='utf-8') as f:
+            version, collected_at = f.read().split('\n', 1)
+        if version == file_version(os.stat(KNOWLEDGE_FILE)):
+            return collected_at.strip()
+    except (OSError, ValueError):
+        # Нет файла или он в старом формате - читаем заголовок базы
+        pass
+    
     try:
         with open(KNOWLEDGE_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                if 'Время сбора:' in line:
-                    return line.split('Время сбора: ')[1].strip()
+            collected_at = get_collection_time(f)
+        if collected_at:
+            return collected_at
     except:
         pass
     return "Неизвестно"
 
 async def main():
     """Основная функция запуска бота"""
+    global _http_session
+    
+    log_listener.start()
+    
     # Создаем необходимые директории
     os.makedirs('database', exist_ok=True)
     os.makedirs('logs', exist_ok=True)
     
     # Инициализируем БД
     DatabaseManager.init_db()
+    write_queue.start()
+    load_accuracy_stats()
+    
+    # Строим поисковый индекс заранее, чтобы первый вопрос не ждал разбора базы
+    KnowledgeBase.load_articles()
     
     logger.info("Запуск бота МосОблЕИРЦ...")
     logger.info(f"Telegram Bot Token: {TELEGRAM_BOT_TOKEN[:10]}...")
     logger.info(f"HuggingFace API Key: {HUGGINGFACE_API_KEY[:10]}...")
     
+    # Одна сессия на всё время работы: соединения и DNS переиспользуются между запросами
+    _http_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    
     try:
         await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Ошибка запуска бота: {e}")
     finally:
+        async with _stats_lock:
+            await flush_accuracy_stats()
+        await _http_session.close()
         await bot.session.close()
+        await write_queue.stop()
+        DatabaseManager.close_db()
+        log_listener.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
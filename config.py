@@ -9,9 +9,11 @@ KNOWLEDGE_FILE = "database/knowledge.txt"
 TEMP_KNOWLEDGE_FILE = "database/temp_knowledge.txt"
 BACKUP_KNOWLEDGE_FILE = "database/knowledge_backup.txt"
 USER_DB_FILE = "database/users.db"
+LAST_UPDATE_FILE = "database/last_update.txt"
+STATS_FILE = "database/stats.json"
 
 # ID администраторов (ЗАМЕНИТЕ НА ВАШИ REAL TELEGRAM ID)
-ADMIN_IDS = [6910167987]  # ⚠️ ЗАМЕНИТЕ ЭТОТ ID НА ВАШ ТЕЛЕГРАМ ID
+ADMIN_IDS = frozenset({6910167987})  # ⚠️ ЗАМЕНИТЕ ЭТОТ ID НА ВАШ ТЕЛЕГРАМ ID
 
 # Настройки парсера
 LOGIN_URL = "https://mes1-kms.interrao.ru"
@@ -24,5 +26,6 @@ MAX_RESPONSE_LENGTH = 1000
 # Настройки приложения
 LOG_LEVEL = "INFO"
 REQUEST_TIMEOUT = 30
+RESPONSE_CACHE_SIZE = 512  # Сколько последних ответов держать в памяти
 
 
@@ -1,6 +1,7 @@
 import os
-import time
+import re
 import logging
+from collections import Counter
 from datetime import datetime
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -9,9 +10,43 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from config import LOGIN_URL, BASE_URL, KNOWLEDGE_FILE, TEMP_KNOWLEDGE_FILE
+from database_manager import iter_articles
 
 logger = logging.getLogger(__name__)
 
+# Ссылки на статьи на странице пространства
+ARTICLE_LINK_SELECTOR = "a[href*='/article/']"
+
+# Элементы с содержанием статьи, в порядке приоритета
+CONTENT_SELECTORS = ('.article-content', '.content', '.main-content', 'article', '[role="main"]')
+
+# Возвращает текст первого видимого элемента длиннее 50 символов
+# по первому из селекторов arguments[0], у которого такой элемент нашелся
+FIND_CONTENT_SCRIPT = """
+for (const selector of arguments[0]) {
+    for (const element of document.querySelectorAll(selector)) {
+        if (!element.getClientRects().length) continue;
+        const text = element.innerText.trim();
+        if (text.length > 50) return text;
+    }
+}
+return null;
+"""
+
+# Сколько ждать загрузки страницы, секунд
+PAGE_LOAD_TIMEOUT = 15
+
+# Слова, по которым статья считается содержащей скрипт для оператора.
+# Поиск подстрок в тексте, приведенном к нижнему регистру, быстрее
+# регулярного выражения с IGNORECASE примерно на порядок
+_SCRIPT_KEYWORDS = ('сказать', 'рекомендовать', 'советовать', 'информировать', 'объяснить')
+
+# Слова из 4+ русских букв для подсчета ключевых слов
+_KEYWORD_RE = re.compile(r'\b[а-яё]{4,}\b')
+
+# Стоп-слова, не считающиеся ключевыми
+_STOP_WORDS = frozenset({'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а', 'то', 'все', 'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же', 'вы', 'за', 'бы', 'по', 'только', 'ее', 'мне', 'было', 'вот', 'от', 'меня', 'еще', 'нет', 'о', 'из', 'ему', 'теперь', 'когда', 'даже', 'ну', 'ли', 'если', 'уже', 'или', 'ни', 'быть', 'был', 'него', 'до', 'вас', 'нибудь', 'опять', 'уж', 'вам', 'ведь', 'там', 'потом', 'себя', 'ничего', 'ей', 'может', 'они', 'тут', 'где', 'есть', 'надо', 'ней', 'для', 'мы', 'тебя', 'их', 'чем', 'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз', 'тоже', 'себе', 'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того', 'потому', 'этого', 'какой', 'совсем', 'ним', 'здесь', 'этом', 'один', 'почти', 'мой', 'тем', 'чтобы', 'неё', 'сейчас', 'были', 'куда', 'зачем', 'всех', 'никогда', 'можно', 'при', 'наконец', 'два', 'об', 'другой', 'хоть', 'после', 'над', 'больше', 'тот', 'через', 'эти', 'нас', 'про', 'всего', 'них', 'какая', 'много', 'разве', 'три', 'эту', 'моя', 'впрочем', 'хорошо', 'свою', 'этой', 'перед', 'иногда', 'лучше', 'чуть', 'том', 'нельзя', 'такой', 'им', 'более', 'всегда', 'конечно', 'всю', 'между'})
+
 class EnhancedParser:
     """Расширенный парсер для сбора базы знаний"""
     
@@ -32,7 +67,9 @@ class EnhancedParser:
             options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
             
             self.driver = webdriver.Chrome(options=options)
-            self.driver.implicitly_wait(10)
+            # Неявное ожидание не используем: каждый поиск отсутствующего элемента
+            # стоил бы полного таймаута; загрузку страниц ждем явно (wait_for_page_load)
+            self.driver.implicitly_wait(0)
             logger.info("Веб-драйвер успешно запущен")
             return True
             
@@ -56,37 +93,64 @@ class EnhancedParser:
             logger.error("Таймаут ожидания входа")
             return False
     
+    def wait_for_page_load(self, locator=None, timeout=PAGE_LOAD_TIMEOUT):
+        """Ждет загрузки документа (и появления locator, если задан) вместо фиксированной паузы.
+        
+        По таймауту не прерывает сбор: работаем с тем, что успело загрузиться.
+        """
+        wait = WebDriverWait(self.driver, timeout)
+        try:
+            wait.until(lambda driver: driver.execute_script('return document.readyState') == 'complete')
+            if locator:
+                wait.until(EC.presence_of_element_located(locator))
+        except TimeoutException:
+            logger.warning(f"Страница не загрузилась за {timeout} с: {self.driver.current_url}")
+    
+    def wait_for_content(self, timeout=PAGE_LOAD_TIMEOUT):
+        """Ждет, пока в статье отрисуется блок с содержанием, и возвращает его текст (None по таймауту)"""
+        try:
+            return WebDriverWait(self.driver, timeout).until(
+                lambda driver: driver.execute_script(FIND_CONTENT_SCRIPT, list(CONTENT_SELECTORS))
+            )
+        except TimeoutException:
+            logger.warning(f"Не дождались содержания статьи: {self.driver.current_url}")
+            return None
+    
     def collect_articles_from_space(self, space_url):
         """Собирает статьи из пространства"""
         try:
             self.driver.get(space_url)
-            time.sleep(3)
+            self.wait_for_page_load((By.CSS_SELECTOR, ARTICLE_LINK_SELECTOR))
             
             articles_data = []
             
-            # Поиск ссылок на статьи
-            article_links = self.driver.find_elements(By.CSS_SELECTOR, "a[href*='/article/']")
-            logger.info(f"Найдено ссылок на статьи: {len(article_links)}")
+            # Поиск ссылок на статьи. Адреса и заголовки забираем сразу, одним
+            # запросом к браузеру: после перехода на статью элементы страницы
+            # пространства становятся недействительными (StaleElementReference)
+            article_links = self.driver.execute_script(
+                "return Array.from(document.querySelectorAll(arguments[0]),"
+                " a => [a.href, a.innerText.trim()]);",
+                ARTICLE_LINK_SELECTOR
+            )
+            # Одна статья может быть в нескольких ссылках (меню, список) - берем первую с текстом
+            unique_links = {}
+            for article_url, article_title in article_links:
+                if article_url and article_title and article_url not in unique_links:
+                    unique_links[article_url] = article_title
+            logger.info(f"Найдено ссылок на статьи: {len(unique_links)}")
             
-            for i, link in enumerate(article_links[:50]):  # Ограничиваем для демо
+            for i, (article_url, article_title) in enumerate(list(unique_links.items())[:50]):  # Ограничиваем для демо
                 try:
-                    article_url = link.get_attribute('href')
-                    article_title = link.text.strip()
-                    
-                    if article_url and article_title:
-                        article_content = self.extract_article_content(article_url)
-                        if article_content:
-                            articles_data.append({
-                                'url': article_url,
-                                'title': article_title,
-                                'content': article_content,
-                                'collected_at': datetime.now().isoformat()
-                            })
-                            self.articles_collected += 1
-                            logger.info(f"Собрана статья {self.articles_collected}: {article_title}")
-                    
-                    # Небольшая пауза между запросами
-                    time.sleep(1)
+                    article_content = self.extract_article_content(article_url)
+                    if article_content:
+                        articles_data.append({
+                            'url': article_url,
+                            'title': article_title,
+                            'content': article_content,
+                            'collected_at': datetime.now().isoformat()
+                        })
+                        self.articles_collected += 1
+                        logger.info(f"Собрана статья {self.articles_collected}: {article_title}")
                     
                 except Exception as e:
                     logger.error(f"Ошибка при сборе статьи {i}: {e}")
@@ -102,53 +166,39 @@ class EnhancedParser:
         """Извлекает содержание статьи"""
         try:
             self.driver.get(article_url)
-            time.sleep(2)
-            
-            content_parts = []
-            
-            # Заголовок
-            try:
-                title = self.driver.find_element(By.TAG_NAME, 'h1').text
-                content_parts.append(f"ЗАГОЛОВОК: {title}")
-            except NoSuchElementException:
-                content_parts.append("ЗАГОЛОВОК: Не указан")
+            self.wait_for_page_load()
             
-            # Основное содержание
+            # Основное содержание. Ждем его первым: оболочка приложения (h1, [role=main])
+            # появляется раньше самой статьи, а заголовок читаем уже после отрисовки
             try:
-                # Пытаемся найти различные элементы с контентом
-                content_selectors = [
-                    '.article-content',
-                    '.content',
-                    '.main-content',
-                    'article',
-                    '[role="main"]'
-                ]
-                
-                for selector in content_selectors:
-                    try:
-                        content_elements = self.driver.find_elements(By.CSS_SELECTOR, selector)
-                        for element in content_elements:
-                            text = element.text.strip()
-                            if text and len(text) > 50:
-                                content_parts.append(f"СОДЕРЖАНИЕ:\n{text}")
-                                break
-                        if len(content_parts) > 1:  # Если нашли контент
-                            break
-                    except:
-                        continue
+                text = self.wait_for_content()
                 
                 # Если не нашли структурированный контент, берем весь текст body
-                if len(content_parts) <= 1:
+                if not text:
                     body_text = self.driver.find_element(By.TAG_NAME, 'body').text
                     # Фильтруем полезный контент
                     lines = body_text.split('\n')
                     useful_lines = [line.strip() for line in lines if len(line.strip()) > 20]
                     if useful_lines:
-                        content_parts.append(f"СОДЕРЖАНИЕ:\n{' '.join(useful_lines[:20])}")
+                        text = ' '.join(useful_lines[:20])
+                
+                content = f"СОДЕРЖАНИЕ:\n{text}" if text else None
                 
             except Exception as e:
                 logger.warning(f"Не удалось извлечь содержание: {e}")
-                content_parts.append("СОДЕРЖАНИЕ: Не удалось загрузить")
+                content = "СОДЕРЖАНИЕ: Не удалось загрузить"
+            
+            content_parts = []
+            
+            # Заголовок
+            try:
+                title = self.driver.find_element(By.TAG_NAME, 'h1').text
+                content_parts.append(f"ЗАГОЛОВОК: {title}")
+            except NoSuchElementException:
+                content_parts.append("ЗАГОЛОВОК: Не указан")
+            
+            if content:
+                content_parts.append(content)
             
             return '\n'.join(content_parts)
             
@@ -158,29 +208,32 @@ class EnhancedParser:
     
     def format_articles_to_knowledge(self, articles_data):
         """Форматирует собранные статьи в формат базы знаний"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Все статьи форматируются в один момент, время берем один раз
+        now = datetime.now()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        processed_at = now.strftime('%H:%M:%S')
         
-        knowledge_content = f"""=== БАЗА ЗНАНИЙ - АВТОМАТИЧЕСКИЙ СБОР ===
+        parts = [f"""=== БАЗА ЗНАНИЙ - АВТОМАТИЧЕСКИЙ СБОР ===
 Время сбора: {timestamp}
 Обработано статей: {len(articles_data)}
 Источник: {BASE_URL}
 ==================================================
 
-"""
+"""]
         
         for i, article in enumerate(articles_data, 1):
-            knowledge_content += f"""СТАТЬЯ {i}: {article['title']}
+            parts.append(f"""СТАТЬЯ {i}: {article['title']}
 URL: {article['url']}
 Заголовок: {article['title']}
-Время обработки: {datetime.now().strftime('%H:%M:%S')}
+Время обработки: {processed_at}
 ---
 {article['content']}
 ---
 ==================================================
 
-"""
+""")
         
-        return knowledge_content
+        return ''.join(parts)
     
     def run_full_parsing(self):
         """Запускает полный процесс парсинга"""
@@ -238,10 +291,9 @@ class SmartParser:
             with open(KNOWLEDGE_FILE, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            articles = content.split('==================================================')
             parsed_data = []
             
-            for article in articles:
+            for article in iter_articles(content):
                 if not article.strip():
                     continue
                 
@@ -298,21 +350,14 @@ class SmartParser:
     @staticmethod
     def has_operator_script(article):
         """Проверяет наличие скрипта для оператора"""
-        keywords = ['сказать', 'рекомендовать', 'советовать', 'информировать', 'объяснить']
         article_lower = article.lower()
-        return any(keyword in article_lower for keyword in keywords)
+        return any(keyword in article_lower for keyword in _SCRIPT_KEYWORDS)
     
     @staticmethod
     def extract_keywords(article, top_n=10):
         """Извлекает ключевые слова из статьи"""
-        from collections import Counter
-        import re
-        
-        # Убираем стоп-слова
-        stop_words = {'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а', 'то', 'все', 'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же', 'вы', 'за', 'бы', 'по', 'только', 'ее', 'мне', 'было', 'вот', 'от', 'меня', 'еще', 'нет', 'о', 'из', 'ему', 'теперь', 'когда', 'даже', 'ну', 'ли', 'если', 'уже', 'или', 'ни', 'быть', 'был', 'него', 'до', 'вас', 'нибудь', 'опять', 'уж', 'вам', 'ведь', 'там', 'потом', 'себя', 'ничего', 'ей', 'может', 'они', 'тут', 'где', 'есть', 'надо', 'ней', 'для', 'мы', 'тебя', 'их', 'чем', 'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз', 'тоже', 'себе', 'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того', 'потому', 'этого', 'какой', 'совсем', 'ним', 'здесь', 'этом', 'один', 'почти', 'мой', 'тем', 'чтобы', 'неё', 'сейчас', 'были', 'куда', 'зачем', 'всех', 'никогда', 'можно', 'при', 'наконец', 'два', 'об', 'другой', 'хоть', 'после', 'над', 'больше', 'тот', 'через', 'эти', 'нас', 'про', 'всего', 'них', 'какая', 'много', 'разве', 'три', 'эту', 'моя', 'впрочем', 'хорошо', 'свою', 'этой', 'перед', 'иногда', 'лучше', 'чуть', 'том', 'нельзя', 'такой', 'им', 'более', 'всегда', 'конечно', 'всю', 'между'}
-        
-        words = re.findall(r'\b[а-яё]{4,}\b', article.lower())
-        filtered_words = [word for word in words if word not in stop_words]
-        
-        word_freq = Counter(filtered_words)
+        # Слова идут в Counter потоком, без промежуточного отфильтрованного списка
+        word_freq = Counter(
+            word for word in _KEYWORD_RE.findall(article.lower()) if word not in _STOP_WORDS
+        )
         return word_freq.most_common(top_n)